@@ -1,6 +1,6 @@
 # app.py — LINE Bot that reads Google Sheets and returns per-entry PDF links (Render friendly)
 # ------------------------------------------------------------
-# 必要: Flask / line-bot-sdk / python-dotenv / gspread / google-auth / reportlab / unidecode / pandas
+# 必要: Flask / line-bot-sdk / python-dotenv / gspread / google-auth / reportlab / unidecode / pandas / rapidfuzz / pyahocorasick
 #
 # 環境変数（Render の Environment Variables で設定）
 #   LINE_CHANNEL_ACCESS_TOKEN : 長期チャネルアクセストークン
@@ -9,34 +9,48 @@
 #   SHEET_ID                  : スプレッドシートID（/spreadsheets/d/ と /edit の間）
 #   WORKSHEET_NAME            : シート名（例: "シート1"）
 #   FONT_PATH                 : （任意）サーバーに置いたNotoSans等のTTFへの相対/絶対パス
+#   CAST_RANGES               : （任意）名簿で使う列範囲をカンマ区切りで指定（例: "A:A,C:F"）。
+#                               指定時はその列だけを1リクエストで取得。未指定ならシート全体。
+#   CAST_TTL                  : （任意）名簿キャッシュの有効秒数（既定 300）
+#   PDF_TTL                   : （任意）生成したPDFをメモリに保持する秒数（既定 86400）
+#   PDF_STORE_MAX             : （任意）メモリに保持するPDFの最大件数（既定 500。超えたら最も使われていないものから破棄）
 #
 # 備考:
 # - LINEはPDFを直接添付できないので、生成したPDFをHTTPで配布するURLをメッセージで返します。
-# - Renderの無料インスタンスはファイル永続化がないため、PDFは一時的（再起動で消える）。
+# - PDFはディスクに書かずプロセスのメモリに保持し、PDF_TTL 秒または PDF_STORE_MAX 件超過で破棄します（再起動でも消える）。
+#   ワーカー間でPDFを共有できないため、gunicorn は gunicorn.conf.py でワーカー1つに固定しています。
+#   起動コマンドで -w / --workers を2以上にするとURLが404になるので指定しないでください。
+#   同時処理は gthread のスレッド（threads = 8）で行い、名簿読込中でもPDF配布や他のWebhookを止めません。
+#   timeout = 180 は名簿読込の最悪時間（Sheets呼び出し最大3回 ×（10秒 × 4回 + 再試行待ち14秒）= 162秒）より長く
+#   してあります。ワーカーが再起動されるとメモリ上のPDFはすべて消えるので、短くしないでください。
 #   長期保管したい場合はS3等の外部ストレージにアップロードしてURLを返してください。
 
-import os, json, re
+import os, io, json, re, threading, time, uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+from urllib.parse import quote
 from unidecode import unidecode
+from rapidfuzz import process, fuzz
+import ahocorasick
+from typing import TYPE_CHECKING
 
-import pandas as pd
-import gspread
-from google.oauth2.service_account import Credentials
+# pandas / gspread / google-auth / reportlab(描画部) は使う関数の中で import する。
+# Renderのコールドスタート直後の /health や署名検証でこれらの読込時間を払わないため。
+if TYPE_CHECKING:
+    import pandas as pd
 
-from flask import Flask, request, abort, send_from_directory
+from flask import Flask, request, abort, send_file
 from dotenv import load_dotenv
 
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 
-# PDF関連 -----------------------------------------------------
-from reportlab.pdfgen import canvas
+# PDF関連（寸法計算のみ。canvas / フォント登録は create_receipt 側で遅延 import）----
 from reportlab.lib.pagesizes import landscape
 from reportlab.lib.units import mm
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.pdfbase import pdfmetrics
-from reportlab.lib import colors
 
 # ------------------------------------------------------------
 # 起動前セットアップ
@@ -45,7 +59,13 @@ CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
 SHEET_ID = os.getenv("SHEET_ID")
 WORKSHEET_NAME = os.getenv("WORKSHEET_NAME", "シート1")
+CAST_RANGES = [r.strip() for r in os.getenv("CAST_RANGES", "").split(",") if r.strip()]
 FONT_PATH = os.getenv("FONT_PATH")
+CACHE_TTL = int(os.getenv("CAST_TTL", "300"))  # 名簿キャッシュの有効秒数
+PDF_TTL = int(os.getenv("PDF_TTL", "86400"))  # 生成PDFの保持秒数
+PDF_STORE_MAX = int(os.getenv("PDF_STORE_MAX", "500"))  # 生成PDFの最大保持件数
+FUZZY_CUTOFF = 85  # 源氏名の表記ゆれ許容スコア（fuzz.ratio, 0-100）
+FUZZY_MIN_LEN = 4  # これより短い名前はあいまい検索しない（短い名前は別人に当たりやすい）
 
 if not CHANNEL_ACCESS_TOKEN or not CHANNEL_SECRET:
     raise RuntimeError("環境変数 LINE_CHANNEL_ACCESS_TOKEN / LINE_CHANNEL_SECRET が未設定です")
@@ -54,26 +74,28 @@ if not os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON"):
 if not SHEET_ID:
     raise RuntimeError("環境変数 SHEET_ID が未設定です")
 
-# 出力ディレクトリ（即時配布用）
-OUTPUT_DIR = os.getenv("OUTPUT_DIR", "./pdfs")
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-# 日本語フォント（任意）
-if FONT_PATH and os.path.exists(FONT_PATH):
-    try:
-        pdfmetrics.registerFont(TTFont('NotoSansJP', FONT_PATH))
-        JP_FONT = 'NotoSansJP'
-    except Exception:
-        JP_FONT = 'Helvetica'
-else:
-    JP_FONT = 'Helvetica'  # フォールバック
-
 # 店舗ワード（必要なら調整）
 STORE_NAMES = {
     "MINE": ["マイン", "まいん", "MINE"],
     "M": ["M", "えむ", "エム"],
 }
 
+
+def _build_store_matcher():
+    """STORE_NAMES の全キーワードを1つの Aho-Corasick オートマトンにまとめる。
+    値は (定義順, 店舗名)。1行に複数ヒットした場合は定義順が先の店舗を優先する。
+    """
+    ac = ahocorasick.Automaton()
+    for order, (store, keys) in enumerate(STORE_NAMES.items()):
+        for k in keys:
+            if k not in ac or ac.get(k)[0] > order:
+                ac.add_word(k, (order, store))
+    ac.make_automaton()
+    return ac
+
+
+STORE_MATCHER = _build_store_matcher()
+
 # Google Sheets 接続 ------------------------------------------
 SCOPES_RO = [
     "https://www.googleapis.com/auth/spreadsheets.readonly",
@@ -83,132 +105,362 @@ SCOPES_RW = [
     "https://www.googleapis.com/auth/spreadsheets",
 ]
 
+SHEETS_RETRIES = 3  # 429/408/5xx の再試行回数（待ちは 2, 4, 8 秒で合計最大14秒）
+SHEETS_TIMEOUT = 10  # Sheets API 1リクエストあたりのタイムアウト秒数
+
+
+@lru_cache(maxsize=None)
+def _backoff_http_client():
+    """429/408/5xx を指数バックオフで SHEETS_RETRIES 回まで再試行する gspread 用HTTPクライアント。
+    gspread の BackOffHTTPClient は回数上限がなく、クォータ超過が続くと名簿ロックを握ったまま
+    待ち続けるため、回数を区切った独自実装にしている。
+    """
+    from gspread.exceptions import APIError
+    from gspread.http_client import HTTPClient
+
+    class _RetryHTTPClient(HTTPClient):
+        # HTTPClient.request と同じ引数。APIError は本文のJSONを前提に組み立てられるため、
+        # 再試行の判定は APIError を作る前にステータスコードで行う。
+        def request(self, method, endpoint, params=None, data=None, json=None,
+                    files=None, headers=None):
+            for attempt in range(SHEETS_RETRIES + 1):
+                response = self.session.request(
+                    method=method, url=endpoint, json=json, params=params, data=data,
+                    files=files, headers=headers, timeout=self.timeout,
+                )
+                if response.ok:
+                    return response
+                code = response.status_code
+                if (code in (408, 429) or code >= 500) and attempt < SHEETS_RETRIES:
+                    time.sleep(2 ** (attempt + 1))
+                    continue
+                try:
+                    err = APIError(response)
+                except ValueError:
+                    # GoogleフロントのHTMLエラーページなど、本文がJSONでない応答
+                    raise RuntimeError(f"Sheets API HTTP {code}: {response.text[:200]}") from None
+                raise err
+
+    return _RetryHTTPClient
+
+
 def _creds(scopes):
+    from google.oauth2.service_account import Credentials
     info = json.loads(os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON"))
     return Credentials.from_service_account_info(info, scopes=scopes)
 
 
-def load_cast_df() -> pd.DataFrame:
+def _merge_column_blocks(blocks: list) -> list:
+    """batchGet の各範囲（列ブロック）を横に連結して1つの2次元リストにする。
+    APIは末尾の空セル・空行を省略して返すので、ブロックごとの列幅まで空文字で埋める。
+    """
+    widths = [max((len(r) for r in b), default=0) for b in blocks]
+    n_rows = max((len(b) for b in blocks), default=0)
+    rows = []
+    for i in range(n_rows):
+        row = []
+        for block, width in zip(blocks, widths):
+            cells = block[i] if i < len(block) else []
+            row.extend(cells + [""] * (width - len(cells)))
+        rows.append(row)
+    return rows
+
+
+def load_cast_df() -> "pd.DataFrame":
     """スプレッドシートから名簿を取得してDataFrame化。
     想定カラム: 源氏名α / 氏名 / 住所 / 電話番号 / 生年月日
     """
-    gc = gspread.authorize(_creds(SCOPES_RO))
-    ws = gc.open_by_key(SHEET_ID).worksheet(WORKSHEET_NAME)
-    rows = ws.get_all_records()  # 1行目がヘッダ
-    df = pd.DataFrame(rows)
+    import gspread
+    import pandas as pd
+
+    gc = gspread.authorize(_creds(SCOPES_RO), http_client=_backoff_http_client())
+    gc.set_timeout(SHEETS_TIMEOUT)
+    sh = gc.open_by_key(SHEET_ID)
+    if CAST_RANGES:
+        # 必要な列だけを1回の batchGet で取得
+        resp = sh.values_batch_get([f"'{WORKSHEET_NAME}'!{r}" for r in CAST_RANGES])
+        vals = _merge_column_blocks([vr.get("values", []) for vr in resp.get("valueRanges", [])])
+    else:
+        vals = sh.worksheet(WORKSHEET_NAME).get_all_values()  # 値は文字列のまま取得
+    # 1行目がヘッダ
+    if not vals:
+        return pd.DataFrame()
+    df = pd.DataFrame(vals[1:], columns=vals[0])
     return df
 
+
+@lru_cache(maxsize=4096)
+def _norm(s: str) -> str:
+    """源氏名の照合用キー（ローマ字化・前後空白除去・小文字化）。同じ名前は再計算しない。"""
+    return unidecode(s).strip().lower()
+
+
+def build_roster_index(df: "pd.DataFrame") -> dict:
+    """源氏名α を正規化したキー → 行(dict) の索引を作る。重複時は先頭行を優先。
+    源氏名αが空の行（正規化して空になるものも含む）は誰にも一致させないため登録しない。
+    """
+    if '源氏名α' not in df.columns:
+        return {}
+    roster = {}
+    for key, row in zip(df['源氏名α'], df.to_dict('records')):
+        norm = _norm(str(key))
+        if norm:
+            roster.setdefault(norm, row)
+    return roster
+
+
+# 名簿キャッシュ（メッセージ毎にSheets APIを叩かないようにプロセス内で保持）
+_CAST_CACHE = {"roster": None, "choices": None, "ts": 0.0}
+_CAST_LOCK = threading.Lock()
+
+
+def get_roster():
+    """CACHE_TTL 秒以内なら前回取得した名簿索引を返し、期限切れ時のみ再取得する。
+    戻り値: (索引dict, あいまい検索用キー一覧)
+    """
+    with _CAST_LOCK:
+        if _CAST_CACHE["roster"] is not None and time.time() - _CAST_CACHE["ts"] < CACHE_TTL:
+            return _CAST_CACHE["roster"], _CAST_CACHE["choices"]
+        roster = build_roster_index(load_cast_df())
+        _CAST_CACHE["roster"] = roster
+        _CAST_CACHE["choices"] = list(roster.keys())
+        _CAST_CACHE["ts"] = time.time()
+        return roster, _CAST_CACHE["choices"]
+
+
+def find_cast(name2: str, roster: dict, choices: list):
+    """完全一致を優先し、見つからない場合のみ RapidFuzz で近い源氏名を探す。
+    戻り値: (行 or None, あいまい一致したか)
+    """
+    key = _norm(name2)
+    if not key:
+        return None, False  # ★や絵文字など、ローマ字化できない名前は照合しない
+    row = roster.get(key)
+    if row is not None or not choices or len(key) < FUZZY_MIN_LEN:
+        return row, False
+    # 部分一致で採点する WRatio は短い名前が別人に当たるので、全体比較の ratio を使う
+    match = process.extractOne(key, choices, scorer=fuzz.ratio, score_cutoff=FUZZY_CUTOFF)
+    return (roster[match[0]], True) if match else (None, False)
+
 # PDF作成 -----------------------------------------------------
 COMMON_COMPANY_NAME = "JOBドラゴン"
+# 領収書は1件ずつ独立しているので並行に生成する
+PDF_POOL = ThreadPoolExecutor(max_workers=min(8, (os.cpu_count() or 2) * 2))
+
+
+# 配布用PDFのメモリ置き場: ファイル名 → (PDFバイト列, 生成時刻)
+# 参照されたものを末尾へ移す LRU（先頭が最も使われていない）
+PDF_STORE = OrderedDict()
+_PDF_LOCK = threading.Lock()
 
 
 def get_unique_path(base_path: str) -> str:
-    if not os.path.exists(base_path):
-        return base_path
+    """ランダムな接尾辞を付けて一意なパスを返す（存在確認なしで並行生成しても衝突しない）。"""
     stem, ext = os.path.splitext(base_path)
-    i = 2
-    while os.path.exists(f"{stem}_{i}{ext}"):
-        i += 1
-    return f"{stem}_{i}{ext}"
+    return f"{stem}_{uuid.uuid4().hex[:8]}{ext}"
+
+
+def store_pdf(token: str, data: bytes):
+    """PDFをメモリに登録し、PDF_TTL を過ぎたものと PDF_STORE_MAX 件を超えた古いものを破棄する。"""
+    now = time.time()
+    with _PDF_LOCK:
+        for k in [k for k, (_, ts) in PDF_STORE.items() if now - ts >= PDF_TTL]:
+            del PDF_STORE[k]
+        PDF_STORE[token] = (data, now)
+        PDF_STORE.move_to_end(token)
+        while len(PDF_STORE) > PDF_STORE_MAX:
+            PDF_STORE.popitem(last=False)
+
+
+def get_pdf(token: str):
+    """有効期限内のPDFを (PDFバイト列, 生成時刻) で返す（無ければ None）。参照したものはLRUの末尾へ。"""
+    with _PDF_LOCK:
+        entry = PDF_STORE.get(token)
+        if entry is None or time.time() - entry[1] >= PDF_TTL:
+            return None
+        PDF_STORE.move_to_end(token)
+        return entry
+
+
+PAGE_SIZE = landscape((180 * mm, 100 * mm))
+
+# 描画座標（ページサイズ固定なので事前計算しておく）
+_W, _H = PAGE_SIZE
+_RECT_BAND = (10 * mm, _H - 47 * mm, _W - 20 * mm, 12 * mm)    # 金額の帯
+_RECT_FRAME = (10 * mm, 10 * mm, _W - 20 * mm, _H - 20 * mm)   # 外枠
+_X_ISSUE, _Y_NO, _Y_ISSUE = _W - 60 * mm, _H - 22 * mm, _H - 30 * mm
+_X_NOTE, _Y_NOTE = 20 * mm + 75, _H - 56 * mm
+_X_TITLE, _Y_TITLE = 20 * mm + 175, _H - 20 * mm
+_X_COMPANY, _Y_COMPANY = 20 * mm + 15, _H - 30 * mm
+_X_AMOUNT, _Y_AMOUNT = 20 * mm + 150, _H - 44 * mm
+_X_DETAIL = 20 * mm + 90
+_Y_DETAIL = (_H - 65 * mm, _H - 70 * mm, _H - 75 * mm, _H - 80 * mm)  # 氏名/住所/電話/生年月日
+_X_NAME2, _Y_NAME2 = 20 * mm + 240, _H - 80 * mm
+
+
+@lru_cache(maxsize=None)
+def _jp_font() -> str:
+    """日本語フォント（任意）を初回のPDF作成時に一度だけ登録し、フォント名を返す。"""
+    if FONT_PATH and os.path.exists(FONT_PATH):
+        from reportlab.pdfbase.ttfonts import TTFont
+        from reportlab.pdfbase import pdfmetrics
+        try:
+            pdfmetrics.registerFont(TTFont('NotoSansJP', FONT_PATH))
+            return 'NotoSansJP'
+        except Exception:
+            return 'Helvetica'
+    return 'Helvetica'  # フォールバック
+
+
+@lru_cache(maxsize=None)
+def _template_ops() -> tuple:
+    """金額帯・外枠など毎回同じ図形の描画を一度だけ記録し、PDFオペレータ列として返す。
+    文字列はTTFのサブセット割当が文書ごとに変わるため記録せず、都度描画する。
+    """
+    from reportlab.pdfgen import canvas
+    from reportlab.lib import colors
+
+    c = canvas.Canvas(io.BytesIO(), pagesize=PAGE_SIZE)
+    c.setFillColor(colors.lightgrey)
+    c.rect(*_RECT_BAND, fill=1, stroke=0)
+    c.setStrokeColor(colors.black)
+    c.rect(*_RECT_FRAME, stroke=1, fill=0)
+    return tuple(c._code)
 
 
 def create_receipt(company_name: str, name: str, amount: int, address: str,
-                   phone_number: str, birthdate: str, file_path: str,
+                   phone_number: str, birthdate: str, file_name: str,
                    issue_date: str, name2: str):
-    custom_size = (180 * mm, 100 * mm)
-    file_path = get_unique_path(file_path)
-    c = canvas.Canvas(file_path, pagesize=landscape(custom_size))
-    width, height = landscape(custom_size)
+    """領収書PDFをメモリ上に生成し、(配布用ファイル名, PDFバイト列) を返す。"""
+    from reportlab.pdfgen import canvas
+    from reportlab.lib import colors
 
-    c.setFillColor(colors.lightgrey)
-    c.rect(10 * mm, height - 47 * mm, width - 20 * mm, 12 * mm, fill=1, stroke=0)
+    jp_font = _jp_font()
+    token = get_unique_path(file_name)
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=PAGE_SIZE)
 
-    c.setStrokeColor(colors.black)
-    c.rect(10 * mm, 10 * mm, width - 20 * mm, height - 20 * mm, stroke=1, fill=0)
+    c._code.extend(_template_ops())  # 固定の図形を再生
 
+    # フォントはサイズごとにまとめて描画し、切替はサイズ変更のみにする
     c.setFillColor(colors.black)
-    c.setFont(JP_FONT, 16)
-    c.drawString(20 * mm + 175, height - 20 * mm, "領収書")
-
-    c.setFont(JP_FONT, 12)
-    c.drawString(width - 60 * mm, height - 22 * mm, f"No.   ")
-    c.drawString(width - 60 * mm, height - 30 * mm, f"発行日 {issue_date}")
+    c.setFont(jp_font, 12)
+    c.drawString(_X_ISSUE, _Y_NO, f"No.   ")
+    c.drawString(_X_ISSUE, _Y_ISSUE, f"発行日 {issue_date}")
+    c.drawString(_X_NOTE, _Y_NOTE, "但し 業務委託費として、上記正に領収いたしました")
 
-    c.setFont(JP_FONT, 17)
-    c.drawString(20 * mm + 15, height - 30 * mm, COMMON_COMPANY_NAME)
+    c.setFontSize(16)
+    c.drawString(_X_TITLE, _Y_TITLE, "領収書")
 
-    c.setFont(JP_FONT, 22)
-    c.drawString(20 * mm + 150, height - 44 * mm, f"¥ {amount}-")
+    c.setFontSize(17)
+    c.drawString(_X_COMPANY, _Y_COMPANY, COMMON_COMPANY_NAME)
 
-    c.setFont(JP_FONT, 12)
-    c.drawString(20 * mm + 75, height - 56 * mm, "但し 業務委託費として、上記正に領収いたしました")
+    c.setFontSize(22)
+    c.drawString(_X_AMOUNT, _Y_AMOUNT, f"¥ {amount}-")
 
     if name2 != COMMON_COMPANY_NAME:
-        c.setFont(JP_FONT, 10)
-        c.drawString(20 * mm + 90, height - 65 * mm, f"{name}")
-        c.drawString(20 * mm + 90, height - 70 * mm, f"{address}")
-        c.drawString(20 * mm + 90, height - 75 * mm, f"{phone_number}")
-        c.drawString(20 * mm + 90, height - 80 * mm, f"生年月日 {birthdate}")
+        c.setFontSize(10)
+        c.drawString(_X_DETAIL, _Y_DETAIL[0], f"{name}")
+        c.drawString(_X_DETAIL, _Y_DETAIL[1], f"{address}")
+        c.drawString(_X_DETAIL, _Y_DETAIL[2], f"{phone_number}")
+        c.drawString(_X_DETAIL, _Y_DETAIL[3], f"生年月日 {birthdate}")
 
-    c.setFont(JP_FONT, 28)
+    c.setFontSize(28)
     c.setFillColor(colors.purple if name2 != COMMON_COMPANY_NAME else colors.black)
-    c.drawString(20 * mm + 240, height - 80 * mm, name2)
+    c.drawString(_X_NAME2, _Y_NAME2, name2)
 
     c.showPage()
     c.save()
-    return file_path
+    return token, buf.getvalue()
 
 # 文字列解析 ---------------------------------------------------
-LINE_PATTERN = re.compile(r"([^-\d\s]+)\s*¥?([\d,]+)")  # 例: 佐藤 12000 / 佐藤 ¥12,000
+# 行全体を fullmatch で照合（例: 佐藤 12000 / 佐藤 ¥12,000 / 佐藤 12,000円）
+LINE_PATTERN = re.compile(r"(?P<name>[^\-\d\s¥]+)\s*¥?(?P<amt>[\d,]+)\s*円?")
+AMOUNT_STRIP = str.maketrans("", "", "¥,")
+
+
+def _parse_amount(s: str):
+    try:
+        return int(s.translate(AMOUNT_STRIP))
+    except ValueError:
+        return None
 
 
 def detect_store_and_parse_lines(text: str):
-    """メッセージ本文から店舗の切替と (name2, amount) のタプル配列を抽出。
+    """メッセージ本文から店舗の切替と (store, name2, amount) のタプル配列を抽出。
     店舗行: ラインに MINE / M などのキーワードが含まれる行で切替。
     データ行: 名前 金額
+    戻り値: (items, invalid)。invalid は店舗指定後に現れた、店舗行でもデータ行でもない行。
     """
     current_store = None
     items = []  # (store, name2, amount)
+    invalid = []
 
     for raw in text.splitlines():
         line = raw.strip()
         if not line:
             continue
         # 店舗切替
-        for store, keys in STORE_NAMES.items():
-            if any(k in line for k in keys):
-                current_store = store
-                break
-        m = LINE_PATTERN.match(line)
+        hits = [v for _, v in STORE_MATCHER.iter(line)]
+        if hits:
+            current_store = min(hits)[1]
+        m = LINE_PATTERN.fullmatch(line)
         if m and current_store:
-            name2, amount_s = m.groups()
-            try:
-                amount = int(amount_s.replace(',', ''))
-            except ValueError:
-                continue
-            items.append((current_store, name2.strip(), amount))
-    return items
+            amount = _parse_amount(m["amt"])
+            if amount is None:
+                invalid.append(line)
+            else:
+                items.append((current_store, m["name"].strip(), amount))
+        elif current_store and not hits:
+            invalid.append(line)  # 末尾に余分な文字がある行など。黙って捨てずに案内する
+    return items, invalid
 
 # Flask & LINE -------------------------------------------------
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = 1024 * 1024  # Webhook本文の上限。超過は読まずに413を返す
 line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(CHANNEL_SECRET)
 
 
+def flush(texts: list, reply_token: str, user_id: str):
+    """texts を5件ずつ（LINEの1回あたり上限）に分けて送信する。
+    先頭チャンクは reply、残りは push で送る。入力順に届くよう1チャンクずつ順番に送信する。
+    """
+    chunks = [[TextSendMessage(text=t) for t in texts[i:i+5]]
+              for i in range(0, len(texts), 5)]
+    if not chunks:
+        return
+    line_bot_api.reply_message(reply_token, chunks[0])
+    for chunk in chunks[1:]:
+        line_bot_api.push_message(user_id, chunk)
+
+
 @app.get("/health")
 def health():
     return "OK", 200
 
 
-# PDF配布用の静的エンドポイント（短期配布向け）
+# PDF配布用のエンドポイント（短期配布向け・メモリから返す）
 @app.get("/pdfs/<path:filename>")
 def serve_pdf(filename):
-    return send_from_directory(OUTPUT_DIR, filename, as_attachment=False)
+    entry = get_pdf(filename)
+    if entry is None:
+        abort(404)
+    # ファイル名は内容ごとに一意なので immutable。個人情報を含むため共有キャッシュには置かせず、
+    # 期限もサーバー側の保持期間（PDF_TTL）を超えないようにする（304/Range にも対応）
+    resp = send_file(io.BytesIO(entry[0]), mimetype="application/pdf",
+                     as_attachment=False, download_name=filename,
+                     conditional=True, etag=quote(filename), last_modified=entry[1])
+    max_age = max(0, int(PDF_TTL - (time.time() - entry[1])))
+    resp.headers["Cache-Control"] = f"private, max-age={max_age}, immutable"
+    return resp
 
 
 @app.post("/callback")
 def callback():
     signature = request.headers.get("X-Line-Signature", "")
+    if not signature:
+        abort(400)  # 署名なしは本文の解析やHMAC計算をせずに弾く
     body = request.get_data(as_text=True)
     try:
         handler.handle(body, signature)
@@ -222,19 +474,19 @@ def on_message(event: MessageEvent):
     text = (event.message.text or "").strip()
 
     # 入力解析（店舗 → 名前 金額...）
-    items = detect_store_and_parse_lines(text)
+    items, invalid = detect_store_and_parse_lines(text)
+    format_errors = [f"【形式エラー】{line}（『名前 金額』の形で送ってください）" for line in invalid]
     if not items:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage("形式: 店舗名を含む行で切替し、その下に『名前 金額』を並べて送ってください\n例)\nMINE\n佐藤 12000\n鈴木 15000\nM\n田中 8000")
-        )
+        # 名簿（Sheets/pandas）に触れる前に返す
+        flush(["形式: 店舗名を含む行で切替し、その下に『名前 金額』を並べて送ってください\n例)\nMINE\n佐藤 12000\n鈴木 15000\nM\n田中 8000"]
+              + format_errors, event.reply_token, event.source.user_id)
         return
 
     # 名簿ロード
     try:
-        cast_df = load_cast_df()
+        roster, choices = get_roster()
     except Exception as e:
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(f"名簿読込エラー: {e}"))
+        flush([f"名簿読込エラー: {e}"], event.reply_token, event.source.user_id)
         return
 
     # PDFを生成してURLを収集
@@ -242,69 +494,50 @@ def on_message(event: MessageEvent):
     base_url = request.host_url.rstrip('/')  # 例: https://service.onrender.com
 
     urls = []
-    errors = []
+    errors = list(format_errors)
 
+    jobs = []  # (store, name2, 表示名, amount, future)
+    seen = {}  # (name2, amount) → (表示名, future)。同じ内容は1回だけ生成して同じURLを返す
     for store, name2, amount in items:
-        name_ascii = unidecode(name2)
-        hit = cast_df[cast_df.get('源氏名α', pd.Series(dtype=str)) == name_ascii]
-        if hit.empty:
+        if (name2, amount) in seen:
+            label, future = seen[(name2, amount)]
+            jobs.append((store, name2, label, amount, future))
+            continue
+        row, fuzzy = find_cast(name2, roster, choices)
+        if row is None:
             errors.append(f"【未登録】{store} {name2} {amount:,}")
             continue
-        # 1件に決め打ち
-        row = hit.iloc[0]
+        # あいまい一致は照合先を返信に明記して、利用者が取り違えに気付けるようにする
+        label = f"{name2}（→{row.get('源氏名α', '')}?）" if fuzzy else name2
+        file_name = f"{name2}_{amount}.pdf".replace('/', '_')
+        future = PDF_POOL.submit(
+            create_receipt,
+            company_name=COMMON_COMPANY_NAME,
+            name=str(row.get('氏名', '')),
+            amount=int(amount),
+            address=str(row.get('住所', '')),
+            phone_number=str(row.get('電話番号', '')),
+            birthdate=str(row.get('生年月日', '')),
+            file_name=file_name,
+            issue_date=issue_date,
+            name2=name2,
+        )
+        seen[(name2, amount)] = (label, future)
+        jobs.append((store, name2, label, amount, future))
+
+    # 入力順を保ったまま結果を回収
+    for store, name2, label, amount, future in jobs:
         try:
-            file_name = f"{name2}_{amount}.pdf".replace('/', '_')
-            file_path = os.path.join(OUTPUT_DIR, file_name)
-            out = create_receipt(
-                company_name=COMMON_COMPANY_NAME,
-                name=str(row.get('氏名', '')),
-                amount=int(amount),
-                address=str(row.get('住所', '')),
-                phone_number=str(row.get('電話番号', '')),
-                birthdate=str(row.get('生年月日', '')),
-                file_path=file_path,
-                issue_date=issue_date,
-                name2=name2,
-            )
-            url = f"{base_url}/pdfs/{os.path.basename(out)}"
-            urls.append(f"{store} {name2} ¥{amount:,} → {url}")
+            token, data = future.result()
+            store_pdf(token, data)
+            url = f"{base_url}/pdfs/{token}"
+            urls.append(f"{store} {label} ¥{amount:,} → {url}")
         except Exception as e:
             errors.append(f"作成失敗: {store} {name2} {amount:,} ({e})")
 
-    # 返信 — LINEは1回のreplyで最大5メッセージ
-    messages = []
-    if urls:
-        for u in urls:
-            messages.append(TextSendMessage(text=u))
-            if len(messages) == 5:
-                line_bot_api.reply_message(event.reply_token, messages)
-                messages = []
-                # 以降はpushで送る
-        if messages:
-            line_bot_api.reply_message(event.reply_token, messages)
-            messages = []
-        # まだ残りがある場合はpush（ユーザーIDが必要）
-        leftover = urls[5:]
-        if leftover:
-            for i in range(0, len(leftover), 5):
-                line_bot_api.push_message(event.source.user_id,
-                                          [TextSendMessage(text=t) for t in leftover[i:i+5]])
-    else:
-        # 成功ゼロ
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("該当がありませんでした。"))
-
-    # 未登録や失敗の案内
-    if errors:
-        chunk = []
-        for e in errors:
-            chunk.append(e)
-            if len(chunk) == 5:
-                line_bot_api.push_message(event.source.user_id,
-                                          [TextSendMessage(text=t) for t in chunk])
-                chunk = []
-        if chunk:
-            line_bot_api.push_message(event.source.user_id,
-                                      [TextSendMessage(text=t) for t in chunk])
+    # 返信 — URL（成功ゼロなら案内）→ 未登録や失敗の案内 の順にまとめて5件ずつ送る
+    texts = (urls or ["該当がありませんでした。"]) + errors
+    flush(texts, event.reply_token, event.source.user_id)
 
 
 if __name__ == "__main__":
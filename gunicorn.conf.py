@@ -0,0 +1,12 @@
+# gunicorn.conf.py — gunicorn が起動ディレクトリから自動で読み込む設定
+# 生成PDFはプロセスのメモリ（app.PDF_STORE）に保持しているため、ワーカーは必ず1つにする。
+# 2以上にすると、URLへのアクセスがPDFを持たないワーカーに振られて404になる。
+workers = 1
+
+# 1ワーカーでも名簿読込（Sheetsの再試行を含む）中にPDF配布や他のWebhookを処理できるようスレッドで並行処理する
+worker_class = "gthread"
+threads = 8
+
+# 名簿読込の最悪時間（Sheets呼び出し最大3回 ×（10秒 × 4回 + 再試行待ち14秒）= 162秒）より長くする。
+# タイムアウトでワーカーが再起動されるとメモリ上のPDFがすべて消え、送信済みURLが404になる。
+timeout = 180